@@ -14,7 +14,11 @@ logging.getLogger('PIL').setLevel(logging.ERROR)
 
 import streamlit as st
 import sqlite3
-import json
+import math
+import queue
+import threading
+from collections import OrderedDict
+from contextlib import closing, contextmanager
 from datetime import datetime
 from kyc_agent import (
     process_kyc_workflow, 
@@ -22,9 +26,14 @@ from kyc_agent import (
     init_database,
     check_and_notify_expired_ids,
     get_expired_customers,
-    revalidate_all_records
+    revalidate_all_records,
+    VALID_EXPIRY_SQL,
+    DAYS_UNTIL_EXPIRY_SQL,
+    json_dumps,
+    json_loads
 )
 from groq import Groq
+import httpx
 from dotenv import load_dotenv
 
 #streamlit warnings 
@@ -39,67 +48,350 @@ if not api_key:
     st.error("⚠️ GROQ_API_KEY not found in .env file. Please add your API key.")
     st.info("Get a free Groq API key at: https://console.groq.com/")
     st.stop()
-client = Groq(api_key=api_key)
+
+@st.cache_resource
+def get_groq():
+    """Groq client shared across reruns so its HTTP connection pool stays warm"""
+    http_client = httpx.Client(limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=60))
+    return Groq(api_key=api_key, http_client=http_client)
 
 st.set_page_config(page_title="KYC Compliance Agent", page_icon="🔐", layout="wide")
 
 # Initialize database
 init_database()
 
+DB_PATH = 'kyc_compliance.db'
+POOL_SIZE = 8
+RECORDS_PAGE_SIZE = 25
+DB_MMAP_SIZE = 256 * 1024 * 1024
+
+@st.cache_resource
+def _init_pool():
+    """Create the shared SQLite connection pool (once per server process)"""
+    pool = queue.LifoQueue(maxsize=POOL_SIZE)
+    for _ in range(POOL_SIZE):
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=256)
+        # Memory-mapped reads must be enabled before the connection's first read
+        conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-20000')
+        pool.put(conn)
+    return pool
+
+# Connection currently borrowed by this script thread, if any
+_borrowed = threading.local()
+
+@contextmanager
 def get_db_connection():
-    return sqlite3.connect('kyc_compliance.db')
+    """Borrow a pooled connection for the duration of a `with` block
+    
+    Nested uses on the same thread reuse the outer connection, so helpers called
+    inside the per-rerun block share its connection and read snapshot.
+    """
+    conn = getattr(_borrowed, 'conn', None)
+    if conn is not None:
+        yield conn
+        return
+    
+    pool = _init_pool()
+    conn = pool.get()
+    _borrowed.conn = conn
+    try:
+        yield conn
+    finally:
+        _borrowed.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        pool.put(conn)
+
+# Static instructions for the assistant. Kept byte-identical across calls and
+# placed first in `messages` so Groq's prompt caching can reuse the prefix.
+ASSISTANT_SYSTEM_PROMPT = """You are a helpful KYC compliance assistant. Answer the user's question about the KYC database.
+
+Use the run_sql tool to look up only the data you need; never guess values that are not in the database.
+Status values are APPROVED, REJECTED and HUMAN_REVIEW_NEEDED. Dates are stored as YYYY-MM-DD text.
+
+Provide a clear, concise answer. If asked to list customers, format them nicely. 
+Include relevant details like customer IDs, status, and any flags."""
+
+# Tables the assistant may read through run_sql
+SQL_TOOL_TABLES = {'kyc_records', 'kyc_flags', 'logs'}
+# Table-valued functions for unpacking the JSON columns (documents, validation_result)
+SQL_TOOL_JSON_TABLES = {'json_each', 'json_tree'}
+SQL_TOOL_MAX_ROWS = 200
+MAX_TOOL_ROUNDS = 5
+
+RUN_SQL_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "run_sql",
+        "description": (
+            "Run one read-only SQLite SELECT statement against the KYC database and return the rows as JSON. "
+            "Tables: kyc_records(customer_id, customer_email, email_date, status, name, dob, id_number, id_type, "
+            "id_expiry, address, documents, validation_result, compliance_report, processed_at), "
+            "kyc_flags(customer_id, flag) with one row per flag, and "
+            "logs(id, timestamp, customer_id, action, details). "
+            "documents is a JSON array. status, compliance_report and kyc_flags are authoritative; "
+            "validation_result is a JSON object holding only the rest of the validator output "
+            "(missing_documents, data_consistency and the extracted fields)."
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "query": {"type": "string", "description": "A single SELECT statement"}
+            },
+            "required": ["query"]
+        }
+    }
+}
+
+def _read_only_authorizer(action, arg1, arg2, db_name, trigger):
+    """Allow plain SELECTs over the whitelisted tables, deny everything else"""
+    if action in (sqlite3.SQLITE_SELECT, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE):
+        return sqlite3.SQLITE_OK
+    if action == sqlite3.SQLITE_READ and (arg1 in SQL_TOOL_TABLES or arg1 in SQL_TOOL_JSON_TABLES):
+        return sqlite3.SQLITE_OK
+    # Connecting json_each/json_tree declares their schema, which SQLite reports as sqlite_master
+    # reads and updates; the connection is opened read-only, so nothing can be written
+    if action in (sqlite3.SQLITE_READ, sqlite3.SQLITE_UPDATE) and arg1 == 'sqlite_master':
+        return sqlite3.SQLITE_OK
+    return sqlite3.SQLITE_DENY
+
+def run_sql(query: str) -> str:
+    """Execute an LLM-issued SELECT on a read-only connection"""
+    try:
+        with closing(sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True)) as conn:
+            conn.set_authorizer(_read_only_authorizer)
+            cursor = conn.execute(query)
+            rows = cursor.fetchmany(SQL_TOOL_MAX_ROWS + 1)
+            columns = [d[0] for d in cursor.description or []]
+    except sqlite3.Error as e:
+        return json_dumps({'error': str(e)})
+    
+    result = {'columns': columns, 'rows': rows[:SQL_TOOL_MAX_ROWS]}
+    if len(rows) > SQL_TOOL_MAX_ROWS:
+        result['truncated'] = True
+    return json_dumps(result, default=str)
+
+# A record's flags as a JSON array, gathered from kyc_flags (idx_flags_customer)
+FLAGS_JSON_SQL = "(SELECT json_group_array(flag) FROM kyc_flags f WHERE f.customer_id = kyc_records.customer_id)"
+
+# Questions set by the example-command buttons
+EXPIRED_IDS_COMMAND = "Show me all customers with expired IDs"
+PENDING_REVIEWS_COMMAND = "Which customers need human review?"
+EXPIRING_SOON_COMMAND = "Show IDs expiring within 30 days"
+RECENT_ACTIVITY_COMMAND = "What are the most recent KYC activities?"
+NOTIFICATIONS_COMMAND = "Send expiry notifications to expired customers"
+COMPLIANCE_REPORT_COMMAND = "Generate a summary compliance report"
+
+# Deterministic SQL for the example commands. Only these exact questions are routed here;
+# everything else (however similar) goes to the LLM.
+CANNED_QUERIES = {
+    EXPIRING_SOON_COMMAND: (
+        "IDs expiring within 30 days",
+        f"""SELECT customer_id, name, id_type, id_expiry, {DAYS_UNTIL_EXPIRY_SQL} AS days_remaining
+        FROM kyc_records
+        WHERE id_expiry BETWEEN date('now', 'localtime') AND date('now', 'localtime', '+30 day')
+          AND {VALID_EXPIRY_SQL}
+        ORDER BY id_expiry""", ()),
+    EXPIRED_IDS_COMMAND: (
+        "Customers with expired IDs",
+        f"""SELECT customer_id, name, id_type, id_expiry, status, -{DAYS_UNTIL_EXPIRY_SQL} AS days_expired
+        FROM kyc_records
+        WHERE id_expiry < date('now', 'localtime') AND {VALID_EXPIRY_SQL}
+        ORDER BY id_expiry""", ()),
+    PENDING_REVIEWS_COMMAND: (
+        "Customers needing human review",
+        f"""SELECT customer_id, name, {FLAGS_JSON_SQL} AS flags, processed_at
+        FROM kyc_records WHERE status = ? ORDER BY processed_at DESC""", ('HUMAN_REVIEW_NEEDED',)),
+    RECENT_ACTIVITY_COMMAND: (
+        "Most recent KYC activity",
+        """SELECT timestamp, customer_id, action, details
+        FROM logs ORDER BY timestamp DESC LIMIT 10""", ()),
+}
+
+def set_question(command: str):
+    """Button callback: put an example command into the question box so it survives later reruns"""
+    st.session_state.question = command
+
+def route_canned_query(question: str):
+    """Return (title, sql, params) when the question is one of the example commands"""
+    return CANNED_QUERIES.get(question.strip())
+
+def run_canned_query(sql: str, params: tuple):
+    """Rows of a canned query as dicts, with JSON flag lists flattened for display"""
+    with get_db_connection() as conn:
+        cursor = conn.execute(sql, params)
+        columns = [d[0] for d in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor]
+    for row in rows:
+        if 'flags' in row:
+            row['flags'] = ', '.join(json_loads(row['flags'])) if row['flags'] else ''
+    return rows
+
+@st.cache_data(ttl=600, max_entries=256)
+def _run_sql_cached(query: str, db_version) -> str:
+    """run_sql result, reused across questions until the database changes"""
+    return run_sql(query)
+
+def _cached_prompt_tokens(usage) -> int:
+    """Number of prompt tokens Groq served from its prompt cache"""
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return getattr(details, 'cached_tokens', 0) or 0
+
+# Answer cache for query_database, keyed on the exact (normalised) question
+QCACHE_SIZE = 64
+
+@st.cache_resource
+def _query_cache():
+    """Recent {(question key, date, db_version): answer} entries, shared across reruns (LRU order)"""
+    return OrderedDict()
+
+def _question_key(question: str) -> str:
+    """Case- and whitespace-insensitive form of a question; anything else is a different question"""
+    return ' '.join(question.lower().split()).rstrip('?.! ')
+
+def _db_version():
+    """Changes whenever a record is (re)inserted or an action is logged"""
+    with get_db_connection() as conn:
+        return conn.execute('SELECT (SELECT MAX(rowid) FROM kyc_records), (SELECT MAX(id) FROM logs)').fetchone()
+
+@st.cache_resource
+def _query_cache_lock():
+    """Sessions run on separate threads; serialize updates to the shared LRU order"""
+    return threading.Lock()
+
+def _cached_answer(key):
+    cache = _query_cache()
+    with _query_cache_lock():
+        answer = cache.get(key)
+        if answer is not None:
+            cache.move_to_end(key)
+    return answer
+
+def _cache_answer(key, answer: str):
+    cache = _query_cache()
+    with _query_cache_lock():
+        cache[key] = answer
+        cache.move_to_end(key)
+        while len(cache) > QCACHE_SIZE:
+            cache.popitem(last=False)
 
 #for querying the database via llm
-def query_database(question: str) -> str:
-    """Use LLM to query database based on natural language"""
+def query_database(question: str):
+    """Use LLM to query database based on natural language, yielding the answer as it streams"""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
+        db_version = _db_version()
+    except Exception as e:
+        yield f"❌ Database error: {e}"
+        return
+    
+    # Only a repeat of the same question against the same data on the same day is served
+    # from cache: the prompt carries today's date, so expiry answers change at midnight
+    today = datetime.now().strftime('%Y-%m-%d')
+    cache_key = (_question_key(question), today, db_version)
+    answer = _cached_answer(cache_key)
+    if answer is not None:
+        yield answer
+        return
+    
+    # Dynamic content goes last so the static system prefix stays cacheable
+    messages = [
+        {"role": "system", "content": ASSISTANT_SYSTEM_PROMPT},
+        {"role": "user", "content": f"Today's date: {today}\n\nQuestion: {question}"}
+    ]
+    
+    # Let the model pull only the rows it needs via run_sql. Text from every round is
+    # streamed, so `shown` keeps the whole display and that is what gets cached
+    answer, shown = "", ""
+    for _ in range(MAX_TOOL_ROUNDS):
+        stream = get_groq().chat.completions.create(
+            model="llama-3.1-8b-instant",
+            messages=messages,
+            tools=[RUN_SQL_TOOL],
+            tool_choice="auto",
+            temperature=0,
+            max_tokens=1500,
+            stream=True
+        )
         
-        # Get all records
-        c.execute('SELECT * FROM kyc_records')
-        records = c.fetchall()
+        content, tool_calls, usage = "", {}, None
+        for chunk in stream:
+            usage = getattr(getattr(chunk, 'x_groq', None), 'usage', None) or usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                content += delta.content
+                shown += delta.content
+                yield delta.content
+            # Tool calls arrive as fragments keyed by index
+            for call in delta.tool_calls or []:
+                entry = tool_calls.setdefault(call.index, {"id": None, "name": "", "arguments": ""})
+                entry["id"] = call.id or entry["id"]
+                if call.function:
+                    entry["name"] += call.function.name or ""
+                    entry["arguments"] += call.function.arguments or ""
+        print(f"🧠 Groq prompt cache: {_cached_prompt_tokens(usage)} cached tokens")
         
-        # Get logs
-        c.execute('SELECT * FROM logs ORDER BY timestamp DESC LIMIT 50')
-        logs = c.fetchall()
-        conn.close()
-    except Exception as e:
-        return f"❌ Database error: {e}"
+        if not tool_calls:
+            answer = content
+            break
+        
+        calls = [tool_calls[i] for i in sorted(tool_calls)]
+        messages.append({
+            "role": "assistant",
+            "content": content,
+            "tool_calls": [{
+                "id": call["id"],
+                "type": "function",
+                "function": {"name": call["name"], "arguments": call["arguments"]}
+            } for call in calls]
+        })
+        for call in calls:
+            try:
+                arguments = json_loads(call["arguments"] or '{}')
+            except ValueError:
+                arguments = None
+            query = arguments.get('query') if isinstance(arguments, dict) else None
+            result = _run_sql_cached(query, db_version) if call["name"] == 'run_sql' and isinstance(query, str) and query else json_dumps({'error': 'Expected run_sql with a query argument'})
+            messages.append({"role": "tool", "tool_call_id": call["id"], "name": call["name"], "content": result})
     
-    #prepare json data for llm prompts 
-    data_summary = f"""
-KYC Records in Database:
-{json.dumps([{
-    'customer_id': r[0], 'status': r[2], 'name': r[3], 'dob': r[4],
-    'id_type': r[6], 'id_expiry': r[7], 'flags': json.loads(r[11]) if r[11] else []
-} for r in records], indent=2)}
-
-Recent Activity Logs:
-{json.dumps([{'timestamp': l[1], 'customer_id': l[2], 'action': l[3]} for l in logs[:10]], indent=2)}
-"""
+    if not answer:
+        yield "⚠️ Could not answer that question from the database. Please try rephrasing it."
+        return
     
-    prompt = f"""You are a KYC compliance assistant. Answer the following question based on the database:
+    _cache_answer(cache_key, shown)
 
-Question: {question}
+@st.cache_data
+def _sidebar_stats(db_version):
+    """Sidebar counters, reused until the database changes (same key as the dashboard lists)"""
+    with get_db_connection() as conn:
+        # One scan for every counter instead of one query per metric
+        return conn.execute('''SELECT COUNT(*),
+                                      COALESCE(SUM(CASE WHEN status = ? THEN 1 ELSE 0 END), 0),
+                                      COALESCE(SUM(CASE WHEN status = ? THEN 1 ELSE 0 END), 0),
+                                      COALESCE(SUM(CASE WHEN status = ? THEN 1 ELSE 0 END), 0),
+                                      COALESCE(SUM(CASE WHEN customer_email IS NOT NULL THEN 1 ELSE 0 END), 0)
+                               FROM kyc_records''', ('APPROVED', 'REJECTED', 'HUMAN_REVIEW_NEEDED')).fetchone()
 
-Database Data:
-{data_summary}
+@st.cache_data
+def _load_status_records(status: str, db_version):
+    """Dashboard rows for one status, filtered by SQLite via idx_status"""
+    with get_db_connection() as conn:
+        rows = conn.execute(f'SELECT customer_id, name, {FLAGS_JSON_SQL} FROM kyc_records WHERE status = ?',
+                            (status,)).fetchall()
+    return [{'customer_id': r[0], 'name': r[1], 'flags': json_loads(r[2]) if r[2] else []} for r in rows]
 
-Provide a clear, concise answer. If asked to list customers, format them nicely. 
-Include relevant details like customer IDs, status, and any flags."""
-
-    response = client.chat.completions.create(
-        model="llama-3.1-8b-instant",
-        messages=[
-            {"role": "system", "content": "You are a helpful KYC compliance assistant."},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0,
-        max_tokens=1500
-    )
-    
-    return response.choices[0].message.content
+def _invalidate_caches():
+    """Drop cached DB reads after anything that writes to the database"""
+    _sidebar_stats.clear()
+    _query_cache().clear()
+    _load_status_records.clear()
+    _run_sql_cached.clear()
 
 # Sidebar
 with st.sidebar:
@@ -110,6 +402,7 @@ with st.sidebar:
         with st.spinner("Processing KYC emails..."):
             try:
                 process_kyc_workflow()
+                _invalidate_caches()
                 st.success("✅ Processing complete!")
                 st.rerun()
             except Exception as e:
@@ -119,6 +412,7 @@ with st.sidebar:
         with st.spinner("Re-validating expired IDs..."):
             try:
                 updated = revalidate_all_records()
+                _invalidate_caches()
                 if updated > 0:
                     st.success(f"✅ Updated {updated} records with expired IDs!")
                 else:
@@ -128,30 +422,94 @@ with st.sidebar:
                 st.error(f"Error: {str(e)}")
     
     st.markdown("---")
+
+# Main area
+tab1, tab2, tab3 = st.tabs(["💬 AI Assistant", "📊 Dashboard", "📋 Records"])
+
+# Read-only panels share one pooled connection and one read snapshot per rerun
+with get_db_connection() as conn:
+    conn.execute('BEGIN')
+    db_version = _db_version()
     
     # Quick Stats
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) FROM kyc_records')
-    total = c.fetchone()[0]
-    c.execute('SELECT COUNT(*) FROM kyc_records WHERE status = "APPROVED"')
-    approved = c.fetchone()[0]
-    c.execute('SELECT COUNT(*) FROM kyc_records WHERE status = "REJECTED"')
-    rejected = c.fetchone()[0]
-    c.execute('SELECT COUNT(*) FROM kyc_records WHERE status = "HUMAN_REVIEW_NEEDED"')
-    review = c.fetchone()[0]
-    c.execute('SELECT COUNT(*) FROM kyc_records WHERE customer_email IS NOT NULL')
-    with_email = c.fetchone()[0]
-    conn.close()
+    with st.sidebar:
+        total, approved, rejected, review, with_email = _sidebar_stats(db_version)
+        
+        st.metric("Total KYC Records", total)
+        st.metric("✅ Approved", approved)
+        st.metric("❌ Rejected", rejected)
+        st.metric("⚠️ Needs Review", review)
+        st.metric("📧 With Email", with_email)
     
-    st.metric("Total KYC Records", total)
-    st.metric("✅ Approved", approved)
-    st.metric("❌ Rejected", rejected)
-    st.metric("⚠️ Needs Review", review)
-    st.metric("📧 With Email", with_email)
+    with tab2:
+        st.header("📊 Compliance Dashboard")
+        
+        approved_list = _load_status_records('APPROVED', db_version)
+        review_list = _load_status_records('HUMAN_REVIEW_NEEDED', db_version)
+        rejected_list = _load_status_records('REJECTED', db_version)
+        
+        if approved_list or review_list or rejected_list:
+            # Status breakdown
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.subheader("✅ Approved")
+                for rec in approved_list:
+                    st.success(f"**{rec['customer_id']}** - {rec['name'] or 'N/A'}")
+            
+            with col2:
+                st.subheader("⚠️ Needs Review")
+                for rec in review_list:
+                    st.warning(f"**{rec['customer_id']}** - {rec['name'] or 'N/A'}")
+                    if rec['flags']:
+                        st.caption(f"Flags: {', '.join(rec['flags'])}")
+            
+            with col3:
+                st.subheader("❌ Rejected")
+                for rec in rejected_list:
+                    st.error(f"**{rec['customer_id']}** - {rec['name'] or 'N/A'}")
+        else:
+            st.info("No KYC records found. Click 'Process New KYC Emails' to fetch and process emails.")
 
-# Main area
-tab1, tab2, tab3 = st.tabs(["💬 AI Assistant", "📊 Dashboard", "📋 Records"])
+    with tab3:
+        st.header("📋 All KYC Records")
+        
+        if total:
+            page_count = max(1, math.ceil(total / RECORDS_PAGE_SIZE))
+            page = st.number_input("Page", min_value=1, max_value=page_count, value=1, step=1,
+                                   help=f"{RECORDS_PAGE_SIZE} records per page") - 1
+            
+            # Stream just this page from the cursor; the validation_result blob is never read
+            rows = conn.execute(f'''SELECT customer_id, customer_email, status, name, dob, id_number, id_type,
+                                           id_expiry, compliance_report, validation_result IS NOT NULL,
+                                           {FLAGS_JSON_SQL}, processed_at
+                                    FROM kyc_records ORDER BY processed_at DESC LIMIT ? OFFSET ?''',
+                                (RECORDS_PAGE_SIZE, page * RECORDS_PAGE_SIZE))
+            for (customer_id, customer_email, status, name, dob, id_number, id_type,
+                 id_expiry, compliance_report, has_validation, flags_json, processed_at) in rows:
+                with st.expander(f"**{customer_id}** - {name or 'Unknown'} [{status}]"):
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        st.write(f"**Customer ID:** {customer_id}")
+                        if customer_email:
+                            st.write(f"**Email:** {customer_email} 📧")
+                        st.write(f"**Name:** {name or 'N/A'}")
+                        st.write(f"**DOB:** {dob or 'N/A'}")
+                        st.write(f"**ID Type:** {id_type or 'N/A'}")
+                        st.write(f"**ID Number:** {id_number or 'N/A'}")
+                    
+                    with col2:
+                        st.write(f"**ID Expiry:** {id_expiry or 'N/A'}")
+                        st.write(f"**Status:** {status}")
+                        st.write(f"**Processed:** {processed_at}")
+                        flags = json_loads(flags_json) if flags_json else []
+                        if flags:
+                            st.write(f"**Flags:** {', '.join(flags)}")
+                    
+                    if has_validation:
+                        st.markdown("**Compliance Report:**")
+                        st.info(compliance_report or 'N/A')
+        else:
+            st.info("No records to display.")
 
 with tab1:
     st.header("💬 Ask the KYC Assistant")
@@ -161,31 +519,25 @@ with tab1:
     st.markdown("**Example commands:**")
     col1, col2, col3 = st.columns(3)
     with col1:
-        if st.button("Show expired IDs"):
-            user_question = "Show me all customers with expired IDs"
-        if st.button("Pending reviews"):
-            user_question = "Which customers need human review?"
+        st.button("Show expired IDs", on_click=set_question, args=(EXPIRED_IDS_COMMAND,))
+        st.button("Pending reviews", on_click=set_question, args=(PENDING_REVIEWS_COMMAND,))
     with col2:
-        if st.button("Check expiring soon"):
-            user_question = "Show IDs expiring within 30 days"
-        if st.button("Recent activity"):
-            user_question = "What are the most recent KYC activities?"
+        st.button("Check expiring soon", on_click=set_question, args=(EXPIRING_SOON_COMMAND,))
+        st.button("Recent activity", on_click=set_question, args=(RECENT_ACTIVITY_COMMAND,))
     with col3:
-        if st.button("Send notifications"):
-            user_question = "Send expiry notifications to expired customers"
-        if st.button("Compliance report"):
-            user_question = "Generate a summary compliance report"
+        st.button("Send notifications", on_click=set_question, args=(NOTIFICATIONS_COMMAND,))
+        st.button("Compliance report", on_click=set_question, args=(COMPLIANCE_REPORT_COMMAND,))
     
-    # User input
-    user_question = st.text_input("Your question:", placeholder="e.g., Send notification to customer 98765 or Show expired IDs")
+    # User input; example buttons write into it, so the notification panel's own buttons keep working
+    user_question = st.text_input("Your question:", key="question", placeholder="e.g., Send notification to customer 98765 or Show expired IDs")
     
     if user_question:
         # Check if it's a notification command
-        if any(keyword in user_question.lower() for keyword in ['send notification', 'send email', 'notify', 'send reminder']):
+        if user_question.strip() == NOTIFICATIONS_COMMAND or any(keyword in user_question.lower() for keyword in ['send notification', 'send email', 'notify', 'send reminder']):
             st.markdown("### 📧 Email Notification")
             
             # Get expired customers
-            expired, expiring_soon = get_expired_customers()
+            expired, expiring_soon, has_saved_emails = get_expired_customers()
             
             if expired or expiring_soon:
                 col1, col2 = st.columns(2)
@@ -196,19 +548,13 @@ with tab1:
                 
                 st.markdown("---")
                 
-                # Check if customers have saved emails
-                conn = get_db_connection()
-                c = conn.cursor()
-                c.execute('SELECT COUNT(*) FROM kyc_records WHERE id_expiry IS NOT NULL AND customer_email IS NOT NULL')
-                has_saved_emails = c.fetchone()[0] > 0
-                conn.close()
-                
                 col1, col2 = st.columns(2)
                 
                 with col1:
                     if has_saved_emails and st.button("📧 Send to Saved Emails (Auto)", type="primary"):
                         with st.spinner("Sending notifications to customer emails..."):
                             count = check_and_notify_expired_ids(use_saved_emails=True)
+                            _invalidate_caches()
                             st.success(f"✅ Sent {count} notification emails to customer email addresses!")
                             
                             # Show what was sent
@@ -233,87 +579,32 @@ with tab1:
                         if notification_email and st.button("📧 Send to Test Email"):
                             with st.spinner(f"Sending notifications to {notification_email}..."):
                                 count = check_and_notify_expired_ids(notification_email)
+                                _invalidate_caches()
                                 st.success(f"✅ Sent {count} notification emails to {notification_email}!")
             else:
                 st.success("🎉 No expired or expiring IDs found!")
+        elif user_question.strip() == COMPLIANCE_REPORT_COMMAND:
+            st.markdown("### 📊 Compliance Report")
+            st.text(generate_compliance_report())
+        elif (canned := route_canned_query(user_question)) is not None:
+            # Common questions are answered straight from SQL, no LLM round-trip
+            title, sql, params = canned
+            st.markdown(f"### 🤖 {title}")
+            rows = run_canned_query(sql, params)
+            if rows:
+                st.dataframe(rows, use_container_width=True, hide_index=True)
+            else:
+                st.info("No matching records found.")
         else:
             # Regular query
             with st.spinner("Thinking..."):
-                answer = query_database(user_question)
                 st.markdown("### 🤖 Answer:")
-                st.markdown(answer)
+                # Render tokens as they arrive instead of waiting for the full answer
+                placeholder = st.empty()
+                answer = ""
+                for chunk in query_database(user_question):
+                    answer += chunk
+                    placeholder.markdown(answer + "▌")
+                placeholder.markdown(answer)
                 if 'query' in st.session_state:
                     del st.session_state.query
-
-with tab2:
-    st.header("📊 Compliance Dashboard")
-    
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT * FROM kyc_records')
-    records = c.fetchall()
-    conn.close()
-    
-    if records:
-        # Status breakdown
-        col1, col2, col3 = st.columns(3)
-        with col1:
-            st.subheader("✅ Approved")
-            approved_list = [r for r in records if r[3] == 'APPROVED']
-            for rec in approved_list:
-                st.success(f"**{rec[0]}** - {rec[4] or 'N/A'}")
-        
-        with col2:
-            st.subheader("⚠️ Needs Review")
-            review_list = [r for r in records if r[3] == 'HUMAN_REVIEW_NEEDED']
-            for rec in review_list:
-                st.warning(f"**{rec[0]}** - {rec[4] or 'N/A'}")
-                flags = json.loads(rec[12]) if rec[12] else []
-                if flags:
-                    st.caption(f"Flags: {', '.join(flags)}")
-        
-        with col3:
-            st.subheader("❌ Rejected")
-            rejected_list = [r for r in records if r[3] == 'REJECTED']
-            for rec in rejected_list:
-                st.error(f"**{rec[0]}** - {rec[4] or 'N/A'}")
-    else:
-        st.info("No KYC records found. Click 'Process New KYC Emails' to fetch and process emails.")
-
-with tab3:
-    st.header("📋 All KYC Records")
-    
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT * FROM kyc_records ORDER BY processed_at DESC')
-    records = c.fetchall()
-    conn.close()
-    
-    if records:
-        for rec in records:
-            # rec[0]=customer_id, rec[1]=customer_email, rec[2]=email_date, rec[3]=status, rec[4]=name
-            with st.expander(f"**{rec[0]}** - {rec[4] or 'Unknown'} [{rec[3]}]"):
-                col1, col2 = st.columns(2)
-                with col1:
-                    st.write(f"**Customer ID:** {rec[0]}")
-                    if rec[1]:
-                        st.write(f"**Email:** {rec[1]} 📧")
-                    st.write(f"**Name:** {rec[4] or 'N/A'}")
-                    st.write(f"**DOB:** {rec[5] or 'N/A'}")
-                    st.write(f"**ID Type:** {rec[7] or 'N/A'}")
-                    st.write(f"**ID Number:** {rec[6] or 'N/A'}")
-                
-                with col2:
-                    st.write(f"**ID Expiry:** {rec[8] or 'N/A'}")
-                    st.write(f"**Status:** {rec[3]}")
-                    st.write(f"**Processed:** {rec[13]}")
-                    flags = json.loads(rec[12]) if rec[12] else []
-                    if flags:
-                        st.write(f"**Flags:** {', '.join(flags)}")
-                
-                if rec[11]:
-                    validation = json.loads(rec[11])
-                    st.markdown("**Compliance Report:**")
-                    st.info(validation.get('compliance_report', 'N/A'))
-    else:
-        st.info("No records to display.")
@@ -5,13 +5,14 @@ This creates sample data to test the system without needing real emails
 import sqlite3
 import json
 from datetime import datetime, timedelta
-from kyc_agent import init_database, update_temp_db, generate_compliance_report
+from kyc_agent import init_database, bulk_update_temp_db, generate_compliance_report
 
 def create_sample_data():
     """Create sample KYC records for testing"""
     init_database()
     
     print("🧪 Creating sample KYC test data...\n")
+    samples = []
     
     # Sample 1: Approved KYC
     sample1 = {
@@ -27,8 +28,8 @@ def create_sample_data():
         "missing_documents": [],
         "data_consistency": "All data is consistent across documents"
     }
-    update_temp_db("CUST001", datetime.now().isoformat(), sample1, 
-                   ["passport.pdf", "address_proof.pdf", "photo.jpg"])
+    samples.append(("CUST001", datetime.now().isoformat(), sample1, 
+                    ["passport.pdf", "address_proof.pdf", "photo.jpg"]))
     print("✅ Created CUST001 - Approved")
     
     # Sample 2: Expired ID
@@ -45,8 +46,8 @@ def create_sample_data():
         "missing_documents": [],
         "data_consistency": "Data matches across documents"
     }
-    update_temp_db("CUST002", datetime.now().isoformat(), sample2,
-                   ["emirates_id.jpg", "utility_bill.pdf"])
+    samples.append(("CUST002", datetime.now().isoformat(), sample2,
+                    ["emirates_id.jpg", "utility_bill.pdf"]))
     print("❌ Created CUST002 - Rejected (Expired ID)")
     
     # Sample 3: Human review needed
@@ -63,8 +64,8 @@ def create_sample_data():
         "missing_documents": ["Photo ID"],
         "data_consistency": "Inconsistencies detected in name spelling"
     }
-    update_temp_db("CUST003", datetime.now().isoformat(), sample3,
-                   ["passport_blurry.jpg", "address_unclear.pdf"])
+    samples.append(("CUST003", datetime.now().isoformat(), sample3,
+                    ["passport_blurry.jpg", "address_unclear.pdf"]))
     print("⚠️  Created CUST003 - Human Review Needed")
     
     # Sample 4: Missing documents
@@ -81,8 +82,8 @@ def create_sample_data():
         "missing_documents": ["Address proof", "Photograph"],
         "data_consistency": "Insufficient documents to verify consistency"
     }
-    update_temp_db("CUST004", datetime.now().isoformat(), sample4,
-                   ["pan_card.jpg"])
+    samples.append(("CUST004", datetime.now().isoformat(), sample4,
+                    ["pan_card.jpg"]))
     print("⚠️  Created CUST004 - Missing Documents")
     
     # Sample 5: Another approved
@@ -99,10 +100,13 @@ def create_sample_data():
         "missing_documents": [],
         "data_consistency": "Perfect match across all documents"
     }
-    update_temp_db("CUST005", datetime.now().isoformat(), sample5,
-                   ["passport.pdf", "utility_bill.pdf", "photo.jpg"])
+    samples.append(("CUST005", datetime.now().isoformat(), sample5,
+                    ["passport.pdf", "utility_bill.pdf", "photo.jpg"]))
     print("✅ Created CUST005 - Approved")
     
+    # Write all samples in one transaction
+    bulk_update_temp_db(samples)
+    
     print("\n" + "="*60)
     print(generate_compliance_report())
     print("="*60)
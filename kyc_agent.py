@@ -1,14 +1,25 @@
 import os
 import re
 import base64
+import hashlib
+from io import BytesIO
+from string import Template
+from email.mime.text import MIMEText
+from email.generator import BytesGenerator
+import tempfile
+import time
 import sqlite3
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import List, Dict, Any
+from contextlib import closing, contextmanager
 import json
 import warnings
 import logging
 import sys
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Suppress ALL warnings 
 warnings.filterwarnings('ignore')
@@ -24,22 +35,207 @@ from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-import PyPDF2
 import pdfplumber
 from pdf2image import convert_from_path
-import easyocr
-from PIL import Image
-from groq import Groq
+from PIL import Image, ImageOps
+from groq import AsyncGroq
 from dotenv import load_dotenv
 import numpy as np
 
-# Initialize EasyOCR reader (loaded once globally)
-print("🔄 Initializing EasyOCR (first run takes a moment to download models)...")
-ocr_reader = easyocr.Reader(['en'], gpu=False, verbose=False)  # English only, CPU mode, suppress logs
-print("✅ EasyOCR ready!")
-
 load_dotenv()
 
+# orjson is optional: faster (de)serialization on the record hot paths,
+# with the stdlib json module as a drop-in fallback
+try:
+    import orjson
+
+    def json_dumps(obj, default=None) -> str:
+        return orjson.dumps(obj, default=default).decode()
+
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(obj, default=None) -> str:
+        return json.dumps(obj, default=default)
+
+    json_loads = json.loads
+
+# blake3 is optional: a much faster content hash for the OCR cache, sha256 otherwise
+try:
+    from blake3 import blake3 as _content_hasher
+except ImportError:
+    _content_hasher = hashlib.sha256
+
+# Every OCR page is letterboxed to this size (or its transpose, for portrait pages) so pages
+# can be batched together
+OCR_WIDTH, OCR_HEIGHT = 1280, 960
+OCR_BATCH_SIZE = 32  # recognizer crops per batch; multiple of 32 for Tensor Core friendly shapes
+# Full pages per readtext_batched call. CRAFT runs each call's pages in one forward pass,
+# so this bounds detector memory (~1 GB of activations per FP32 page at 1280x960)
+OCR_DETECTOR_BATCH_SIZE = 4
+# Run the PyTorch networks in FP16 on CUDA (KYC_OCR_FP16=0 to keep FP32)
+OCR_FP16 = os.getenv('KYC_OCR_FP16', '1') != '0'
+
+# Optional ONNX Runtime backend for the OCR networks (KYC_OCR_BACKEND=onnx)
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+OCR_BACKEND = os.getenv('KYC_OCR_BACKEND', 'torch').lower()
+OCR_MODEL_DIR = Path('ocr_models')
+# INT8 TensorRT engines need a calibration table per model, e.g. ocr_models/trt_cache/craft_calibration.flatbuffers
+OCR_INT8 = os.getenv('KYC_OCR_INT8', '0') == '1'
+
+class _OnnxNetwork:
+    """Stand-in for an EasyOCR torch network whose forward pass runs in ONNX Runtime
+    
+    EasyOCR's own pre/post-processing (resizing, box merging, cropping, CTC decoding)
+    is kept; only `net(x)` calls are served by the session.
+    """
+    def __init__(self, session: 'ort.InferenceSession', device: str):
+        self.session = session
+        self.device = device
+        self.input_name = session.get_inputs()[0].name
+    
+    def eval(self):
+        return self
+    
+    def __call__(self, x, *unused):
+        import torch
+        outputs = self.session.run(None, {self.input_name: x.detach().cpu().numpy().astype(np.float32)})
+        tensors = tuple(torch.from_numpy(o).to(self.device) for o in outputs)
+        return tensors if len(tensors) > 1 else tensors[0]
+
+def _onnx_session(onnx_path: Path) -> 'ort.InferenceSession':
+    """Inference session preferring TensorRT (FP16 or INT8, engines cached on disk), then CUDA, then CPU"""
+    trt_cache = OCR_MODEL_DIR / 'trt_cache'
+    trt_cache.mkdir(parents=True, exist_ok=True)
+    trt_options = {
+        'trt_fp16_enable': True,
+        'trt_engine_cache_enable': True,
+        'trt_engine_cache_path': str(trt_cache)
+    }
+    if OCR_INT8:
+        calibration_table = f'{onnx_path.stem}_calibration.flatbuffers'
+        if (trt_cache / calibration_table).exists():
+            trt_options.update(trt_int8_enable=True, trt_int8_calibration_table_name=calibration_table)
+        else:
+            print(f"⚠️  No INT8 calibration table {calibration_table} in {trt_cache}; using FP16")
+    preferred = [
+        ('TensorrtExecutionProvider', trt_options),
+        ('CUDAExecutionProvider', {}),
+        ('CPUExecutionProvider', {})
+    ]
+    available = ort.get_available_providers()
+    providers = [(name, opts) for name, opts in preferred if name in available]
+    return ort.InferenceSession(str(onnx_path), providers=providers)
+
+def _export_onnx(module, dummy_input, onnx_path: Path, output_names: List[str], dynamic_axes: Dict):
+    """Export an EasyOCR network to ONNX once; later runs reuse the file"""
+    if onnx_path.exists():
+        return
+    import torch
+    OCR_MODEL_DIR.mkdir(exist_ok=True)
+    print(f"🔄 Exporting {onnx_path.name} (one-time)...")
+    with torch.no_grad():
+        torch.onnx.export(module, dummy_input, str(onnx_path), opset_version=17,
+                          input_names=['input'], output_names=output_names, dynamic_axes=dynamic_axes)
+
+def _attach_onnx_backend(reader):
+    """Swap EasyOCR's CRAFT detector and CRNN recognizer for ONNX Runtime sessions"""
+    if ort is None:
+        print("⚠️  KYC_OCR_BACKEND=onnx but onnxruntime is not installed; using PyTorch")
+        return
+    import torch
+    
+    class _RecognizerExport(torch.nn.Module):
+        """Recognizer with the unused `text` argument dropped, for a single-input export"""
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+        
+        def forward(self, image):
+            return self.model(image, None)
+    
+    # DataParallel wraps the networks when running on GPU
+    detector = getattr(reader.detector, 'module', reader.detector).eval()
+    recognizer = getattr(reader.recognizer, 'module', reader.recognizer).eval()
+    device = next(detector.parameters()).device
+    
+    try:
+        detector_path = OCR_MODEL_DIR / 'craft.onnx'
+        _export_onnx(detector, torch.zeros(1, 3, 640, 640, device=device), detector_path, ['y', 'feature'],
+                     {'input': {0: 'N', 2: 'H', 3: 'W'}, 'y': {0: 'N', 1: 'h', 2: 'w'}, 'feature': {0: 'N', 2: 'h', 3: 'w'}})
+        reader.detector = _OnnxNetwork(_onnx_session(detector_path), reader.device)
+    except Exception as e:
+        print(f"⚠️  ONNX detector unavailable, using PyTorch: {e}")
+    
+    try:
+        recognizer_path = OCR_MODEL_DIR / f'{reader.model_lang}_recognizer.onnx'
+        _export_onnx(_RecognizerExport(recognizer), torch.zeros(1, 1, 64, 256, device=device), recognizer_path, ['preds'],
+                     {'input': {0: 'N', 3: 'W'}, 'preds': {0: 'N', 1: 'T'}})
+        reader.recognizer = _OnnxNetwork(_onnx_session(recognizer_path), reader.device)
+    except Exception as e:
+        print(f"⚠️  ONNX recognizer unavailable, using PyTorch: {e}")
+
+def _warmup_ocr(reader):
+    """Run one throwaway batch so cuDNN autotuning doesn't slow the first real batch
+    
+    Uses the same page count and both page orientations of real detector chunks. A failure here
+    (e.g. out of GPU memory) only costs the warm-up, never the reader itself.
+    """
+    try:
+        for height, width in ((OCR_HEIGHT, OCR_WIDTH), (OCR_WIDTH, OCR_HEIGHT)):
+            reader.readtext_batched(np.zeros([OCR_DETECTOR_BATCH_SIZE, height, width, 3], np.uint8),
+                                    batch_size=OCR_BATCH_SIZE, detail=0)
+    except Exception as e:
+        print(f"⚠️  OCR warm-up failed, continuing without it: {e}")
+        import torch
+        torch.cuda.empty_cache()
+
+_ocr_reader = None
+_OCR_INIT_LOCK = threading.Lock()
+_OCR_LOCK = threading.Lock()  # one batch on the reader at a time across workflow threads
+
+def get_ocr_reader():
+    """Return the shared EasyOCR reader, loading it on first use
+    
+    DB-only callers (reports, expiry checks, the scheduler between runs) never pay for the model
+    load, nor for importing torch/EasyOCR (torchvision, OpenCV, scikit-image) at all.
+    """
+    global _ocr_reader
+    with _OCR_INIT_LOCK:
+        if _ocr_reader is None:
+            print("🔄 Initializing EasyOCR (first run takes a moment to download models)...")
+            import easyocr
+            import torch
+            
+            class _HalfPrecision(torch.nn.Module):
+                """Runs a network in FP16 while EasyOCR keeps feeding and reading FP32 tensors"""
+                def __init__(self, module):
+                    super().__init__()
+                    self.module = module.half()
+                
+                def forward(self, *args):
+                    args = [a.half() if torch.is_tensor(a) and a.is_floating_point() else a for a in args]
+                    outputs = self.module(*args)
+                    if isinstance(outputs, tuple):
+                        return tuple(o.float() for o in outputs)
+                    return outputs.float()
+            
+            gpu = torch.cuda.is_available()
+            reader = easyocr.Reader(['en'], gpu=gpu, cudnn_benchmark=True, verbose=False)  # English only, suppress logs
+            if OCR_BACKEND == 'onnx':
+                _attach_onnx_backend(reader)
+            elif gpu and OCR_FP16:
+                reader.detector = _HalfPrecision(reader.detector).eval()
+                reader.recognizer = _HalfPrecision(reader.recognizer).eval()
+            if gpu:
+                _warmup_ocr(reader)  # also builds/loads the TensorRT engines on the ONNX backend
+            print(f"✅ EasyOCR ready! ({'GPU' if gpu else 'CPU'}, {OCR_BACKEND})")
+            _ocr_reader = reader
+    return _ocr_reader
+
 # Constants
 SCOPES = [
     'https://www.googleapis.com/auth/gmail.readonly',
@@ -49,13 +245,67 @@ DB_PATH = 'kyc_compliance.db'
 DOCS_PATH = Path('kyc_documents')
 DOCS_PATH.mkdir(exist_ok=True)
 
-# Initialize Groq
-api_key = os.getenv('GROQ_API_KEY')
-if not api_key:
-    print("⚠️  Warning: GROQ_API_KEY not set in .env file")
-    print("Please add your Groq API key to continue.")
-    print("Get one free at: https://console.groq.com/")
-client = Groq(api_key=api_key) if api_key else None
+DB_PAGE_SIZE = 4096
+
+def _migrate_page_size():
+    """Rebuild the file with DB_PAGE_SIZE pages if it was created with another size
+    
+    Runs at import, before _CONN switches the file to WAL: page_size cannot change in WAL mode.
+    """
+    with closing(sqlite3.connect(DB_PATH, isolation_level=None)) as conn:
+        if conn.execute('PRAGMA page_size').fetchone()[0] == DB_PAGE_SIZE:
+            return
+        # page_size only applies after VACUUM
+        try:
+            conn.execute('PRAGMA journal_mode=DELETE')
+            conn.execute(f'PRAGMA page_size={DB_PAGE_SIZE}')
+            conn.execute('VACUUM')
+        except sqlite3.OperationalError as e:
+            # Another process (app or scheduler) still has the file open in WAL mode
+            print(f"⚠️  Skipping page_size migration (database in use): {e}")
+
+_migrate_page_size()
+
+# One long-lived autocommit connection shared by every DB helper in this module;
+# writes that belong together are grouped with _transaction()
+_CONN = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+_DB_LOCK = threading.RLock()  # serializes transactions from workflow threads
+_CONN.execute('PRAGMA journal_mode=WAL')
+_CONN.execute('PRAGMA synchronous=NORMAL')
+_CONN.execute('PRAGMA temp_store=MEMORY')
+_CONN.execute('PRAGMA cache_size=-65536')
+_CONN.execute('PRAGMA mmap_size=268435456')
+
+@contextmanager
+def _transaction():
+    """Run the enclosed writes as one BEGIN/COMMIT (a single fsync)
+    
+    Nested uses join the outer transaction; any exception rolls the whole thing back.
+    """
+    with _DB_LOCK:
+        if _CONN.in_transaction:
+            yield _CONN
+            return
+        _CONN.execute('BEGIN IMMEDIATE')
+        try:
+            yield _CONN
+        except BaseException:
+            _CONN.execute('ROLLBACK')
+            raise
+        _CONN.execute('COMMIT')
+
+def get_async_groq_client():
+    """Return a new async Groq client (None if GROQ_API_KEY is missing)
+    
+    Created per workflow run: the client's connection pool belongs to the event loop it is used on.
+    """
+    api_key = os.getenv('GROQ_API_KEY')
+    if not api_key:
+        print("⚠️  Warning: GROQ_API_KEY not set in .env file")
+        print("Please add your Groq API key to continue.")
+        print("Get one free at: https://console.groq.com/")
+        return None
+    return AsyncGroq(api_key=api_key)
 
 # KYC Validation Rules
 KYC_RULES = """
@@ -69,71 +319,128 @@ KYC_RULES = """
 
 def init_database():
     """Initialize SQLite database for KYC records"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS kyc_records (
-        customer_id TEXT PRIMARY KEY,
-        customer_email TEXT,
-        email_date TEXT,
-        status TEXT,
-        name TEXT,
-        dob TEXT,
-        id_number TEXT,
-        id_type TEXT,
-        id_expiry TEXT,
-        address TEXT,
-        documents TEXT,
-        validation_result TEXT,
-        flags TEXT,
-        processed_at TEXT
-    )''')
-    
-    try:
-        c.execute("SELECT customer_email FROM kyc_records LIMIT 1")
-    except sqlite3.OperationalError:
-        print("🔄 Migrating database: Adding customer_email column...")
-        c.execute("ALTER TABLE kyc_records ADD COLUMN customer_email TEXT")
-        conn.commit()
-        print("✅ Database migration complete!")
-    c.execute('''CREATE TABLE IF NOT EXISTS logs (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        timestamp TEXT,
-        customer_id TEXT,
-        action TEXT,
-        details TEXT
-    )''')
-    conn.commit()
-    conn.close()
+    with _transaction() as conn:
+        c = conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS kyc_records (
+            customer_id TEXT PRIMARY KEY,
+            customer_email TEXT,
+            email_date TEXT,
+            status TEXT,
+            name TEXT,
+            dob TEXT,
+            id_number TEXT,
+            id_type TEXT,
+            id_expiry TEXT,
+            address TEXT,
+            documents TEXT,
+            validation_result TEXT,
+            compliance_report TEXT,
+            processed_at TEXT
+        )''')
+        # One row per flag, so flags can be added without rewriting any JSON
+        c.execute('''CREATE TABLE IF NOT EXISTS kyc_flags (
+            customer_id TEXT,
+            flag TEXT
+        )''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_flags_customer ON kyc_flags(customer_id)')
+        
+        try:
+            c.execute("SELECT customer_email FROM kyc_records LIMIT 1")
+        except sqlite3.OperationalError:
+            print("🔄 Migrating database: Adding customer_email column...")
+            c.execute("ALTER TABLE kyc_records ADD COLUMN customer_email TEXT")
+            print("✅ Database migration complete!")
+        
+        try:
+            c.execute("SELECT compliance_report FROM kyc_records LIMIT 1")
+        except sqlite3.OperationalError:
+            # Older databases kept the report and flags only inside JSON; move them out once
+            print("🔄 Migrating database: Adding compliance_report column and kyc_flags table...")
+            c.execute("ALTER TABLE kyc_records ADD COLUMN compliance_report TEXT")
+            c.execute('''UPDATE kyc_records SET compliance_report = json_extract(validation_result, '$.compliance_report')
+                         WHERE json_valid(validation_result)''')
+            c.execute('''INSERT INTO kyc_flags (customer_id, flag)
+                         SELECT r.customer_id, f.value FROM kyc_records r, json_each(r.flags) f
+                         WHERE json_valid(r.flags)''')
+            print("✅ Database migration complete!")
+        
+        if c.execute('PRAGMA user_version').fetchone()[0] < 2:
+            # Status, flags and report now live only in their columns/table; drop the stale
+            # JSON copies and the legacy flags column's contents so nothing can contradict them
+            c.execute('''UPDATE kyc_records
+                         SET validation_result = json_remove(validation_result, '$.validation_status', '$.flags', '$.compliance_report')
+                         WHERE json_valid(validation_result)''')
+            if any(column[1] == 'flags' for column in c.execute('PRAGMA table_info(kyc_records)')):
+                c.execute('UPDATE kyc_records SET flags = NULL WHERE flags IS NOT NULL')
+            c.execute('PRAGMA user_version = 2')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_status ON kyc_records(status)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_expiry ON kyc_records(id_expiry)')
+        c.execute('''CREATE TABLE IF NOT EXISTS logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT,
+            customer_id TEXT,
+            action TEXT,
+            details TEXT
+        )''')
+
+def _log_actions(conn: sqlite3.Connection, rows: List[tuple]):
+    """Insert (timestamp, customer_id, action, details) log rows (call inside _transaction)"""
+    conn.executemany('INSERT INTO logs (timestamp, customer_id, action, details) VALUES (?, ?, ?, ?)', rows)
 
 def log_action(customer_id: str, action: str, details: str):
     """Log actions to database"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('INSERT INTO logs (timestamp, customer_id, action, details) VALUES (?, ?, ?, ?)',
-              (datetime.now().isoformat(), customer_id, action, details))
-    conn.commit()
-    conn.close()
+    with _transaction() as conn:
+        _log_actions(conn, [(datetime.now().isoformat(), customer_id, action, details)])
+
+_GMAIL_CREDS = None
+_GMAIL_LOCK = threading.Lock()
+_gmail_local = threading.local()
+
+def _gmail_credentials() -> Credentials:
+    """Return the shared OAuth credentials, reading token.json once and refreshing only when expired"""
+    global _GMAIL_CREDS
+    with _GMAIL_LOCK:
+        if _GMAIL_CREDS is not None and _GMAIL_CREDS.valid:
+            return _GMAIL_CREDS
+        
+        if not os.path.exists('credentials.json'):
+            raise FileNotFoundError(
+                "credentials.json not found. Please download OAuth credentials from Google Cloud Console.\n"
+                "See README.md for setup instructions."
+            )
+        
+        creds = _GMAIL_CREDS
+        if creds is None and os.path.exists('token.json'):
+            creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
+                creds = flow.run_local_server(port=0)
+            with open('token.json', 'w') as token:
+                token.write(creds.to_json())
+        _GMAIL_CREDS = creds
+        return creds
 
 def get_gmail_service():
-    """Authenticate and return Gmail API service"""
-    if not os.path.exists('credentials.json'):
-        raise FileNotFoundError(
-            "credentials.json not found. Please download OAuth credentials from Google Cloud Console.\n"
-            "See README.md for setup instructions."
-        )
-    
-    creds = None
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-    return build('gmail', 'v1', credentials=creds)
+    """Return this thread's Gmail API service (the underlying httplib2 client is not thread-safe)
+    
+    The service is built once per thread and rebuilt only if the credentials were replaced.
+    """
+    creds = _gmail_credentials()
+    if getattr(_gmail_local, 'creds', None) is not creds:
+        # Discovery document ships with google-api-python-client; no HTTP fetch needed
+        _gmail_local.service = build('gmail', 'v1', credentials=creds,
+                                     cache_discovery=False, static_discovery=True)
+        _gmail_local.creds = creds
+    return _gmail_local.service
+
+# Subject/sender patterns, compiled once instead of per message
+_RE_EMAIL = re.compile(r'<(.+?)>|^([^\s<>]+@[^\s<>]+)$')
+_RE_KYC = re.compile(r'KYC\s*[:\-]\s*(\w+)', re.IGNORECASE)
+_RE_ID = re.compile(r'ID\s*[:\-]?\s*(\w+)', re.IGNORECASE)
+_RE_DIGITS = re.compile(r'\b(\d{4,})\b')
 
 def fetch_kyc_emails() -> List[Dict[str, Any]]:
     """Fetch emails with subject containing KYC-related keywords"""
@@ -144,32 +451,34 @@ def fetch_kyc_emails() -> List[Dict[str, Any]]:
     
     email_data = []
     for msg in messages:
-        message = service.users().messages().get(userId='me', id=msg['id']).execute()
+        # Headers only; attachment metadata is fetched later by extract_documents
+        message = service.users().messages().get(userId='me', id=msg['id'], format='metadata',
+                                                 metadataHeaders=['Subject', 'From', 'Date']).execute()
         headers = message['payload']['headers']
         subject = next((h['value'] for h in headers if h['name'] == 'Subject'), '')
         
         # Extract sender email address
         sender_email = next((h['value'] for h in headers if h['name'] == 'From'), '')
         # Parse email from "Name <email@example.com>" format
-        email_match = re.search(r'<(.+?)>|^([^\s<>]+@[^\s<>]+)$', sender_email)
+        email_match = _RE_EMAIL.search(sender_email)
         customer_email = email_match.group(1) or email_match.group(2) if email_match else sender_email
         
         # Extract customer_id from various subject formats:
         customer_id = None
         
         # Patterns
-        match = re.search(r'KYC\s*[:\-]\s*(\w+)', subject, re.IGNORECASE)
+        match = _RE_KYC.search(subject)
         if match:
             customer_id = match.group(1)
         
         
         if not customer_id:
-            match = re.search(r'ID\s*[:\-]?\s*(\w+)', subject, re.IGNORECASE)
+            match = _RE_ID.search(subject)
             if match:
                 customer_id = match.group(1)
         
         if not customer_id:
-            match = re.search(r'\b(\d{4,})\b', subject)  # At least 4 digits
+            match = _RE_DIGITS.search(subject)  # At least 4 digits
             if match:
                 customer_id = match.group(1)
         
@@ -178,102 +487,253 @@ def fetch_kyc_emails() -> List[Dict[str, Any]]:
                 'customer_id': customer_id,
                 'customer_email': customer_email,
                 'message_id': msg['id'],
-                'message': message,
                 'date': next((h['value'] for h in headers if h['name'] == 'Date'), '')
             })
             log_action(customer_id, 'EMAIL_FETCHED', f'Subject: {subject}, From: {customer_email}')
     
     return email_data
 
+B64_CHUNK_SIZE = 4 * 256 * 1024  # base64 chars per decode step (a multiple of 4 -> 768 KiB of output)
+
+def _write_base64_file(file_path: Path, data: str):
+    """Decode a urlsafe-base64 attachment straight into a file, one chunk at a time
+    
+    Avoids holding a second full-size copy of multi-MB PDFs in memory.
+    """
+    raw = data.encode('ascii')
+    raw += b'=' * (-len(raw) % 4)  # Gmail sometimes strips the padding
+    with open(file_path, 'wb', buffering=1024 * 1024) as f:
+        for start in range(0, len(raw), B64_CHUNK_SIZE):
+            f.write(base64.urlsafe_b64decode(raw[start:start + B64_CHUNK_SIZE]))
+
 def extract_documents(email_data: Dict[str, Any]) -> List[Path]:
     """Extract and download PDF/image attachments from email"""
     service = get_gmail_service()
     customer_id = email_data['customer_id']
-    message = email_data['message']
+    # Only the MIME part tree is needed to locate attachments
+    message = service.users().messages().get(userId='me', id=email_data['message_id'], format='full',
+                                             fields='id,payload/parts(filename,body,parts)').execute()
     files = []
     
     customer_dir = DOCS_PATH / customer_id
     customer_dir.mkdir(exist_ok=True)
     
+    pending = []  # (file path, attachment id) for parts whose data isn't inline
+    
     def process_parts(parts):
         for part in parts:
             if part.get('filename'):
                 filename = part['filename']
                 if filename.lower().endswith(('.pdf', '.png', '.jpg', '.jpeg')):
+                    file_path = customer_dir / filename
                     if 'data' in part['body']:
-                        data = part['body']['data']
+                        _write_base64_file(file_path, part['body']['data'])
                     else:
-                        att_id = part['body']['attachmentId']
-                        att = service.users().messages().attachments().get(
-                            userId='me', messageId=message['id'], id=att_id).execute()
-                        data = att['data']
-                    
-                    file_data = base64.urlsafe_b64decode(data)
-                    file_path = customer_dir / filename
-                    with open(file_path, 'wb') as f:
-                        f.write(file_data)
+                        pending.append((file_path, part['body']['attachmentId']))
                     files.append(file_path)
             
             if 'parts' in part:
                 process_parts(part['parts'])
     
-    if 'parts' in message['payload']:
-        process_parts(message['payload']['parts'])
+    # The fields mask drops 'payload' entirely for single-part messages
+    process_parts(message.get('payload', {}).get('parts', []))
+    
+    # Download every remaining attachment in one batched round-trip
+    if pending:
+        errors = []
+        
+        def on_attachment(request_id, response, exception, file_path):
+            if exception is not None:
+                errors.append(exception)
+            else:
+                _write_base64_file(file_path, response['data'])
+        
+        batch = service.new_batch_http_request()
+        for file_path, att_id in pending:
+            batch.add(service.users().messages().attachments().get(
+                          userId='me', messageId=message['id'], id=att_id),
+                      callback=lambda rid, resp, exc, fp=file_path: on_attachment(rid, resp, exc, fp))
+        batch.execute()
+        if errors:
+            raise errors[0]
     
     log_action(customer_id, 'DOCUMENTS_EXTRACTED', f'Files: {[f.name for f in files]}')
     return files
 
-def perform_ocr(file_path: Path) -> str:
-    """Perform OCR on PDF or image files using EasyOCR"""
-    text = ""
+PDF_TEXT_PROBE_PAGES = 3
+PDF_TEXT_MIN_CHARS = 50
+
+def _extract_pdf_text(file_path: Path) -> str:
+    """Extract the embedded text layer of a PDF (empty for scanned PDFs)"""
+    try:
+        with pdfplumber.open(file_path) as pdf:
+            # A real text layer shows up within the first few pages; otherwise it's a scan,
+            # so skip pdfminer's layout pass and let OCR handle it
+            if not any(len(page.chars) > PDF_TEXT_MIN_CHARS for page in pdf.pages[:PDF_TEXT_PROBE_PAGES]):
+                return ""
+            return "\n".join(page.extract_text() or "" for page in pdf.pages).strip()
+    except Exception as e:
+        print(f"⚠️  pdfplumber failed: {e}")
+        return ""
+
+OCR_PDF_DPI = 150
+OCR_MAX_PAGES = 10  # KYC documents are short; never render more than this many pages
+
+def _load_ocr_pages(file_path: Path) -> List[np.ndarray]:
+    """Render a PDF or image into RGB page arrays of the common OCR batch size
     
+    Portrait pages get a portrait canvas: a landscape one would shrink an A4 page to ~80 DPI.
+    """
     if file_path.suffix.lower() == '.pdf':
-    #try first with pypdf for parsing text
         try:
-            with open(file_path, 'rb') as f:
-                pdf_reader = PyPDF2.PdfReader(f)
-                for page in pdf_reader.pages:
-                    extracted = page.extract_text()
-                    if extracted:
-                        text += extracted + "\n"
-        except Exception as e:
-            print(f"⚠️  PyPDF2 extraction failed: {e}")
-        
-        # If no text, use OCR
-        if not text.strip():
-            try:
-                with pdfplumber.open(file_path) as pdf:
-                    for page in pdf.pages:
-                        extracted = page.extract_text()
-                        if extracted:
-                            text += extracted + "\n"
-            except Exception as e:
-                print(f"⚠️  pdfplumber failed: {e}")
-                # Fallback to image OCR with EasyOCR
-                try:
-                    images = convert_from_path(file_path)
-                    for img in images:
-                        # Convert PIL image to numpy array for EasyOCR
-                        img_array = np.array(img)
-                        results = ocr_reader.readtext(img_array, detail=0)
-                        text += " ".join(results) + "\n"
-                except Exception as ocr_error:
-                    print(f"❌ OCR failed: {ocr_error}")
-                    print("Note: pdf2image requires poppler. On Windows, install from: https://github.com/oschwartz10612/poppler-windows/releases/")
-                    raise
+            # 150 DPI is plenty for ID scans; Poppler renders pages on every core
+            images = convert_from_path(file_path, dpi=OCR_PDF_DPI, first_page=1, last_page=OCR_MAX_PAGES,
+                                       thread_count=os.cpu_count() or 1)
+        except Exception:
+            print("Note: pdf2image requires poppler. On Windows, install from: https://github.com/oschwartz10612/poppler-windows/releases/")
+            raise
     else:
-        # Image file - Use EasyOCR
+        images = [Image.open(file_path)]
+    
+    # Letterbox instead of stretching so ID scans keep their aspect ratio
+    return [np.asarray(ImageOps.pad(img.convert('RGB'),
+                                    (OCR_WIDTH, OCR_HEIGHT) if img.width >= img.height else (OCR_HEIGHT, OCR_WIDTH),
+                                    color='white'))
+            for img in images]
+
+OCR_CACHE_PATH = DOCS_PATH / '.ocr_cache'
+OCR_CACHE_MAX_AGE_DAYS = 30
+
+def _file_digest(file_path: Path) -> str:
+    """Content hash of a document, used as its OCR cache key"""
+    hasher = _content_hasher()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def _read_ocr_cache(digest: str):
+    """Return cached text for a document hash, or None on a miss"""
+    cache_file = OCR_CACHE_PATH / f'{digest}.txt'
+    try:
+        text = cache_file.read_text(encoding='utf-8')
+    except FileNotFoundError:
+        return None
+    os.utime(cache_file)  # keep recently used entries from being pruned
+    return text
+
+def _write_ocr_cache(digest: str, text: str):
+    """Store extracted text atomically so a concurrent reader never sees a partial file"""
+    OCR_CACHE_PATH.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=OCR_CACHE_PATH, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, OCR_CACHE_PATH / f'{digest}.txt')
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def prune_ocr_cache(max_age_days: int = OCR_CACHE_MAX_AGE_DAYS) -> int:
+    """Delete OCR cache entries not used in the last max_age_days; returns how many were removed"""
+    if not OCR_CACHE_PATH.exists():
+        return 0
+    cutoff = time.time() - max_age_days * 86400
+    removed = 0
+    for cache_file in OCR_CACHE_PATH.iterdir():
+        try:
+            if cache_file.stat().st_mtime < cutoff:
+                cache_file.unlink()
+                removed += 1
+        except FileNotFoundError:
+            continue
+    return removed
+
+def perform_ocr_batch(file_paths: List[Path]) -> Dict[str, str]:
+    """Extract text from several documents, OCR-ing every page that needs it in one batched call
+    
+    Returns a mapping of file name to text; files that could not be read are left out.
+    """
+    texts = {}
+    pages = []  # (file name, page array) for everything without a text layer
+    digests = {}  # file name -> content hash, for files that miss the OCR cache
+    
+    for file_path in file_paths:
         try:
-            # EasyOCR can read directly from file path
-            results = ocr_reader.readtext(str(file_path), detail=0)
-            text = " ".join(results)
+            digest = _file_digest(file_path)
+            cached = _read_ocr_cache(digest)
+            if cached is not None:
+                print(f"♻️  Cached OCR for {file_path.name}")
+                texts[file_path.name] = cached
+                continue
+            digests[file_path.name] = digest
+            
+            print(f"🔎 OCR on {file_path.name}...")
+            if file_path.suffix.lower() == '.pdf':
+                text = _extract_pdf_text(file_path)
+                if text:
+                    texts[file_path.name] = text
+                    continue
+            for page in _load_ocr_pages(file_path):
+                pages.append((file_path.name, page))
         except Exception as e:
-            print(f"❌ Image OCR failed for {file_path.name}: {e}")
-            raise
+            print(f"⚠️  Failed to process {file_path.name}: {e}")
+    
+    # Landscape and portrait pages are batched separately so each chunk stacks into one
+    # contiguous (N, H, W, 3) array
+    by_shape = {}
+    for i, (_, page) in enumerate(pages):
+        by_shape.setdefault(page.shape, []).append(i)
+    
+    page_texts = {}  # page index -> OCR'd text
+    failed = set()  # files with a page in a chunk that failed; their other pages are dropped too
+    for indices in by_shape.values():
+        for start in range(0, len(indices), OCR_DETECTOR_BATCH_SIZE):
+            chunk = indices[start:start + OCR_DETECTOR_BATCH_SIZE]
+            try:
+                batch = np.stack([pages[i][1] for i in chunk])
+                with _OCR_LOCK:
+                    results = get_ocr_reader().readtext_batched(batch, batch_size=OCR_BATCH_SIZE, detail=0)
+            except Exception as e:
+                names = {pages[i][0] for i in chunk}
+                print(f"❌ OCR failed for {', '.join(sorted(names))}: {e}")
+                failed |= names
+                continue
+            for i, words in zip(chunk, results):
+                page_texts[i] = " ".join(words)
+    
+    ocr_text = {}  # file name -> its pages' text, in page order
+    for i, (name, _) in enumerate(pages):
+        if i in page_texts and name not in failed:
+            ocr_text.setdefault(name, []).append(page_texts[i])
+    for name, file_pages in ocr_text.items():
+        texts[name] = "\n".join(file_pages).strip()
+    
+    for name, digest in digests.items():
+        if texts.get(name):
+            try:
+                _write_ocr_cache(digest, texts[name])
+            except OSError as e:
+                print(f"⚠️  Could not cache OCR for {name}: {e}")
     
-    return text.strip()
+    return texts
 
-def validate_documents_with_llm(customer_id: str, documents_text: Dict[str, str]) -> Dict[str, Any]:
+def perform_ocr(file_path: Path) -> str:
+    """Perform OCR on PDF or image files using EasyOCR"""
+    texts = perform_ocr_batch([file_path])
+    if file_path.name not in texts:
+        raise ValueError(f"Could not extract text from {file_path.name}")
+    return texts[file_path.name]
+
+def _flag_list(flags) -> List[str]:
+    """LLM "flags" as a list of strings: null becomes [], a bare value becomes one flag"""
+    if not flags:
+        return []
+    if isinstance(flags, (list, tuple)):
+        return [str(flag) for flag in flags if flag]
+    return [str(flags)]
+
+async def validate_documents_with_llm(client: AsyncGroq, customer_id: str, documents_text: Dict[str, str]) -> Dict[str, Any]:
     """Use LLM to validate KYC documents and extract information"""
     if not client:
         raise ValueError("Groq client not initialized. Please set GROQ_API_KEY in .env file")
@@ -306,7 +766,7 @@ If ID is expired, flag it. If data doesn't match across documents, flag it.
 
 IMPORTANT: Respond with ONLY valid JSON, no additional text."""
 
-    response = client.chat.completions.create(
+    response = await client.chat.completions.create(
         model="llama-3.1-8b-instant",
         messages=[
             {"role": "system", "content": "You are a KYC compliance expert. Always respond with valid JSON only."},
@@ -316,7 +776,8 @@ IMPORTANT: Respond with ONLY valid JSON, no additional text."""
         max_tokens=2000
     )
     
-    result = json.loads(response.choices[0].message.content)
+    result = json_loads(response.choices[0].message.content)
+    result['flags'] = _flag_list(result.get('flags'))
     
     # Post-validation: Check for expired ID (override LLM if needed)
     id_expiry = result.get('id_expiry')
@@ -331,7 +792,7 @@ IMPORTANT: Respond with ONLY valid JSON, no additional text."""
                 result['validation_status'] = 'REJECTED'
                 
                 # Add or update flags
-                flags = result.get('flags', [])
+                flags = result['flags']
                 expiry_flag = f"ID expired {days_expired} days ago on {id_expiry}"
                 if expiry_flag not in flags:
                     flags.append(expiry_flag)
@@ -345,7 +806,7 @@ IMPORTANT: Respond with ONLY valid JSON, no additional text."""
             elif (expiry_date - today).days <= 30:
                 # ID expiring soon - add warning flag
                 days_remaining = (expiry_date - today).days
-                flags = result.get('flags', [])
+                flags = result['flags']
                 warning_flag = f"ID expires in {days_remaining} days"
                 if warning_flag not in flags:
                     flags.append(warning_flag)
@@ -358,29 +819,126 @@ IMPORTANT: Respond with ONLY valid JSON, no additional text."""
     log_action(customer_id, 'LLM_VALIDATION', f'Status: {result.get("validation_status")}')
     return result
 
+UPSERT_KYC_RECORD_SQL = '''INSERT OR REPLACE INTO kyc_records 
+        (customer_id, customer_email, email_date, status, name, dob, id_number, id_type, id_expiry, 
+         address, documents, validation_result, compliance_report, processed_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+
+# Stored as columns / kyc_flags rows, so they are left out of the validation_result JSON
+VALIDATION_COLUMN_KEYS = ('validation_status', 'flags', 'compliance_report')
+
+def _kyc_record_row(customer_id: str, email_date: str, validation_result: Dict[str, Any], documents: List[str], customer_email: str = None) -> tuple:
+    """Build the kyc_records column values for one validation result"""
+    return (customer_id, customer_email, email_date, validation_result.get('validation_status'),
+            validation_result.get('name'), validation_result.get('dob'),
+            validation_result.get('id_number'), validation_result.get('id_type'),
+            validation_result.get('id_expiry'), validation_result.get('address'),
+            json_dumps(documents),
+            json_dumps({k: v for k, v in validation_result.items() if k not in VALIDATION_COLUMN_KEYS}),
+            validation_result.get('compliance_report'), datetime.now().isoformat())
+
+def _write_kyc_records(conn: sqlite3.Connection, records: List[tuple]):
+    """Upsert records and replace their flag rows (call inside _transaction)
+    
+    Args:
+        records: (customer_id, email_date, validation_result, documents[, customer_email]) tuples
+    """
+    conn.executemany(UPSERT_KYC_RECORD_SQL, [_kyc_record_row(*record) for record in records])
+    conn.executemany('DELETE FROM kyc_flags WHERE customer_id = ?', [(record[0],) for record in records])
+    conn.executemany('INSERT INTO kyc_flags (customer_id, flag) VALUES (?, ?)',
+                     [(record[0], flag) for record in records for flag in _flag_list(record[2].get('flags'))])
+
 def update_temp_db(customer_id: str, email_date: str, validation_result: Dict[str, Any], documents: List[str], customer_email: str = None):
     """Update database with KYC validation results"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    # Record, flags and audit log entry commit together
+    with _transaction() as conn:
+        _write_kyc_records(conn, [(customer_id, email_date, validation_result, documents, customer_email)])
+        log_action(customer_id, 'DB_UPDATED', f'Status: {validation_result.get("validation_status")}')
+
+def bulk_update_temp_db(records: List[tuple]):
+    """Update database with many KYC validation results in a single transaction
     
-    c.execute('''INSERT OR REPLACE INTO kyc_records 
-        (customer_id, customer_email, email_date, status, name, dob, id_number, id_type, id_expiry, 
-         address, documents, validation_result, flags, processed_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-        (customer_id, customer_email, email_date, validation_result.get('validation_status'),
-         validation_result.get('name'), validation_result.get('dob'),
-         validation_result.get('id_number'), validation_result.get('id_type'),
-         validation_result.get('id_expiry'), validation_result.get('address'),
-         json.dumps(documents), json.dumps(validation_result),
-         json.dumps(validation_result.get('flags', [])), datetime.now().isoformat()))
-    
-    conn.commit()
-    conn.close()
-    log_action(customer_id, 'DB_UPDATED', f'Status: {validation_result.get("validation_status")}')
+    Args:
+        records: (customer_id, email_date, validation_result, documents[, customer_email]) tuples,
+            the same arguments update_temp_db takes
+    """
+    now = datetime.now().isoformat()
+    
+    with _transaction() as conn:  # one BEGIN/COMMIT, one fsync for the whole batch
+        _write_kyc_records(conn, records)
+        _log_actions(conn, [(now, record[0], 'DB_UPDATED', f'Status: {record[2].get("validation_status")}')
+                            for record in records])
+
+KYC_CONCURRENCY = int(os.getenv('KYC_CONCURRENCY', '8'))
+
+LLM_CONCURRENCY = int(os.getenv('KYC_LLM_CONCURRENCY', '8'))  # in-flight Groq requests (rate limits)
+
+def _prepare_one(email_data: Dict[str, Any]):
+    """Download and OCR one KYC email's documents
+    
+    Returns (email_data, documents, documents_text), or None if there is nothing to validate.
+    """
+    customer_id = email_data['customer_id']
+    print(f"\n📋 Processing KYC for customer: {customer_id}")
+    
+    try:
+        # Extract documents
+        documents = extract_documents(email_data)
+        print(f"📎 {customer_id}: Extracted {len(documents)} documents")
+        
+        if not documents:
+            print(f"⚠️  No documents found for {customer_id}")
+            return None
+        
+        # Perform OCR (all of this customer's pages in one batch)
+        documents_text = perform_ocr_batch(documents)
+        
+        if not documents_text:
+            print(f"⚠️  No text extracted from documents for {customer_id}")
+            return None
+        return email_data, documents, documents_text
+    
+    except Exception as e:
+        print(f"❌ Error processing {customer_id}: {e}")
+        log_action(customer_id, 'ERROR', str(e))
+        return None
+
+async def _validate_and_store(client: AsyncGroq, semaphore: asyncio.Semaphore, email_data: Dict[str, Any],
+                              documents: List[Path], documents_text: Dict[str, str]):
+    """Validate one customer's documents with the LLM and save the result"""
+    customer_id = email_data['customer_id']
+    try:
+        async with semaphore:
+            print(f"🤖 {customer_id}: Validating with AI...")
+            validation = await validate_documents_with_llm(client, customer_id, documents_text)
+        
+        # Update database
+        update_temp_db(customer_id, email_data['date'], validation, [d.name for d in documents], email_data.get('customer_email'))
+        
+        status = validation.get('validation_status')
+        print(f"✅ {customer_id}: Status: {status}")
+        flags = _flag_list(validation.get('flags'))
+        if flags:
+            print(f"🚩 {customer_id}: Flags: {', '.join(flags)}")
+    
+    except Exception as e:
+        print(f"❌ Error processing {customer_id}: {e}")
+        log_action(customer_id, 'ERROR', str(e))
+
+async def _validate_all(prepared: List[tuple]):
+    """Run every customer's LLM validation concurrently, at most LLM_CONCURRENCY at a time"""
+    client = get_async_groq_client()
+    semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+    try:
+        await asyncio.gather(*[_validate_and_store(client, semaphore, *item) for item in prepared])
+    finally:
+        if client:
+            await client.close()
 
 def process_kyc_workflow():
     """Main workflow to process KYC emails"""
     init_database()
+    prune_ocr_cache()
     print("🔍 Fetching KYC emails...")
     
     try:
@@ -394,90 +952,39 @@ def process_kyc_workflow():
     
     print(f"📧 Found {len(emails)} KYC emails")
     
-    for email_data in emails:
-        customer_id = email_data['customer_id']
-        print(f"\n📋 Processing KYC for customer: {customer_id}")
-        
-        try:
-            # Extract documents
-            documents = extract_documents(email_data)
-            print(f"📎 Extracted {len(documents)} documents")
-            
-            if not documents:
-                print(f"⚠️  No documents found for {customer_id}")
-                continue
-            
-            # Perform OCR
-            documents_text = {}
-            for doc in documents:
-                print(f"🔎 OCR on {doc.name}...")
-                try:
-                    text = perform_ocr(doc)
-                    documents_text[doc.name] = text
-                except Exception as ocr_error:
-                    print(f"⚠️  Failed to process {doc.name}: {ocr_error}")
-                    continue
-            
-            if not documents_text:
-                print(f"⚠️  No text extracted from documents for {customer_id}")
-                continue
-            
-            # Validate with LLM
-            print(f"🤖 Validating with AI...")
-            validation = validate_documents_with_llm(customer_id, documents_text)
-            
-            # Update database
-            update_temp_db(customer_id, email_data['date'], validation, [d.name for d in documents], email_data.get('customer_email'))
-            
-            status = validation.get('validation_status')
-            print(f"✅ Status: {status}")
-            if validation.get('flags'):
-                print(f"🚩 Flags: {', '.join(validation['flags'])}")
-        
-        except Exception as e:
-            print(f"❌ Error processing {customer_id}: {e}")
-            log_action(customer_id, 'ERROR', str(e))
-            continue
+    # Downloads and OCR overlap on a thread pool...
+    with ThreadPoolExecutor(max_workers=KYC_CONCURRENCY) as executor:
+        prepared = [item for item in executor.map(_prepare_one, emails) if item]
+    
+    # ...then all the Groq calls go out together
+    if prepared:
+        asyncio.run(_validate_all(prepared))
 
 def generate_compliance_report() -> str:
     """Generate a summary compliance report"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT * FROM kyc_records')
-    records = c.fetchall()
-    conn.close()
+    with _DB_LOCK:
+        counts = dict(_CONN.execute('SELECT status, COUNT(*) FROM kyc_records GROUP BY status').fetchall())
     
     report = f"📊 KYC Compliance Report ({datetime.now().strftime('%Y-%m-%d %H:%M')})\n"
     report += "=" * 60 + "\n\n"
     
-    approved = sum(1 for r in records if r[2] == 'APPROVED')
-    rejected = sum(1 for r in records if r[2] == 'REJECTED')
-    review = sum(1 for r in records if r[2] == 'HUMAN_REVIEW_NEEDED')
-    
-    report += f"Total Records: {len(records)}\n"
-    report += f"✅ Approved: {approved}\n"
-    report += f"❌ Rejected: {rejected}\n"
-    report += f"⚠️  Human Review Needed: {review}\n"
+    report += f"Total Records: {sum(counts.values())}\n"
+    report += f"✅ Approved: {counts.get('APPROVED', 0)}\n"
+    report += f"❌ Rejected: {counts.get('REJECTED', 0)}\n"
+    report += f"⚠️  Human Review Needed: {counts.get('HUMAN_REVIEW_NEEDED', 0)}\n"
     
     return report
 
-def send_email_notification(to_email: str, customer_id: str, customer_name: str, id_expiry: str, reason: str = "expired"):
-    """Send automated email notification for KYC renewal"""
-    from email.mime.text import MIMEText
-    from email.mime.multipart import MIMEMultipart
-    import base64
-    
-    service = get_gmail_service()
-    
-    # Email templates
-    if reason == "expired":
-        subject = f"⚠️ KYC Update Required - ID Expired for {customer_id}"
-        body = f"""
-Dear {customer_name or 'Valued Customer'},
+# Notification (subject, body) templates, parsed once; only the per-customer fields are substituted
+NOTIFICATION_TEMPLATES = {
+    "expired": (
+        Template("⚠️ KYC Update Required - ID Expired for ${customer_id}"),
+        Template("""
+Dear ${customer_name},
 
 This is an automated notification from our KYC Compliance System.
 
-Our records indicate that your identification document has expired on {id_expiry}.
+Our records indicate that your identification document has expired on ${id_expiry}.
 
 🔔 Action Required:
 To continue using our services without interruption, please update your KYC documents by submitting:
@@ -487,7 +994,7 @@ To continue using our services without interruption, please update your KYC docu
 
 📧 How to Update:
 Reply to this email with your updated documents attached, or send a new email with subject:
-"KYC - {customer_id}"
+"KYC - ${customer_id}"
 
 ⏰ Important: Please complete this process within 7 days to avoid service suspension.
 
@@ -498,15 +1005,16 @@ KYC Compliance Team
 
 ---
 This is an automated message. For assistance, please contact support.
-"""
-    elif reason == "expiring_soon":
-        subject = f"🔔 Reminder: Your ID will expire soon - {customer_id}"
-        body = f"""
-Dear {customer_name or 'Valued Customer'},
+""")
+    ),
+    "expiring_soon": (
+        Template("🔔 Reminder: Your ID will expire soon - ${customer_id}"),
+        Template("""
+Dear ${customer_name},
 
 This is a friendly reminder from our KYC Compliance System.
 
-Your identification document is set to expire on {id_expiry} (within 30 days).
+Your identification document is set to expire on ${id_expiry} (within 30 days).
 
 📋 Proactive Action:
 To ensure uninterrupted service, we recommend updating your KYC documents before expiry:
@@ -515,7 +1023,7 @@ To ensure uninterrupted service, we recommend updating your KYC documents before
 - Clear photograph
 
 📧 How to Update:
-Send an email with your updated documents with subject: "KYC - {customer_id}"
+Send an email with your updated documents with subject: "KYC - ${customer_id}"
 
 Thank you for keeping your information current!
 
@@ -524,33 +1032,50 @@ KYC Compliance Team
 
 ---
 This is an automated reminder. You will receive another notification if your ID expires.
-"""
-    else:
-        subject = f"KYC Verification Required - {customer_id}"
-        body = f"""
-Dear {customer_name or 'Valued Customer'},
+""")
+    ),
+}
+GENERIC_NOTIFICATION_TEMPLATE = (
+    Template("KYC Verification Required - ${customer_id}"),
+    Template("""
+Dear ${customer_name},
 
 Our KYC Compliance System requires your attention.
 
-Customer ID: {customer_id}
-Reason: {reason}
+Customer ID: ${customer_id}
+Reason: ${reason}
 
 Please submit your KYC documents at your earliest convenience.
 
 Best regards,
 KYC Compliance Team
-"""
+""")
+)
+GMAIL_SEND_BATCH_SIZE = 50  # Gmail's recommended ceiling for sends per batch request
+
+def _build_notification(to_email: str, customer_id: str, customer_name: str, id_expiry: str, reason: str) -> str:
+    """Render a notification email as the base64url 'raw' value Gmail's send API expects"""
+    subject_tpl, body_tpl = NOTIFICATION_TEMPLATES.get(reason, GENERIC_NOTIFICATION_TEMPLATE)
+    fields = {'customer_name': customer_name or 'Valued Customer', 'customer_id': customer_id,
+              'id_expiry': id_expiry, 'reason': reason}
     
-    # Create message
-    message = MIMEMultipart()
+    message = MIMEText(body_tpl.substitute(fields), 'plain', 'utf-8')
     message['to'] = to_email
-    message['subject'] = subject
-    message.attach(MIMEText(body, 'plain'))
+    message['subject'] = subject_tpl.substitute(fields)
+    
+    # Serialize straight to bytes and encode those, with no intermediate str of the message
+    buffer = BytesIO()
+    BytesGenerator(buffer).flatten(message)
+    return base64.urlsafe_b64encode(buffer.getvalue()).decode('ascii')
+
+def send_email_notification(to_email: str, customer_id: str, customer_name: str, id_expiry: str, reason: str = "expired"):
+    """Send automated email notification for KYC renewal"""
+    service = get_gmail_service()
     
     # Encode and send
     try:
-        raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-        send_message = service.users().messages().send(
+        raw_message = _build_notification(to_email, customer_id, customer_name, id_expiry, reason)
+        service.users().messages().send(
             userId='me',
             body={'raw': raw_message}
         ).execute()
@@ -563,6 +1088,58 @@ KYC Compliance Team
         log_action(customer_id, 'EMAIL_FAILED', f'Error: {str(e)}')
         return False
 
+def send_email_notifications(notifications: List[tuple]) -> int:
+    """Send many notifications through batched Gmail requests; returns how many were sent
+    
+    Args:
+        notifications: (to_email, customer_id, customer_name, id_expiry, reason) tuples,
+            the same arguments send_email_notification takes
+    
+    The EMAIL_SENT / EMAIL_FAILED log entries are written together once every batch has finished.
+    """
+    service = get_gmail_service()
+    now = datetime.now().isoformat()
+    log_rows = []
+    
+    for start in range(0, len(notifications), GMAIL_SEND_BATCH_SIZE):
+        chunk = notifications[start:start + GMAIL_SEND_BATCH_SIZE]
+        outcomes = {}  # batch request id -> exception (None on success)
+        
+        def on_sent(request_id, response, exception):
+            outcomes[request_id] = exception
+        
+        batch = service.new_batch_http_request(callback=on_sent)
+        for n, notification in enumerate(chunk):
+            batch.add(service.users().messages().send(userId='me', body={'raw': _build_notification(*notification)}),
+                      request_id=str(n))
+        try:
+            batch.execute()
+        except Exception as e:
+            # The whole HTTP request failed; anything without its own answer failed with it
+            for n in range(len(chunk)):
+                outcomes.setdefault(str(n), e)
+        
+        for n, (to_email, customer_id, _, _, reason) in enumerate(chunk):
+            exception = outcomes.get(str(n))
+            if exception is None:
+                print(f"✅ Email sent to {to_email} for {customer_id}")
+                log_rows.append((now, customer_id, 'EMAIL_SENT', f'Reason: {reason}, To: {to_email}'))
+            else:
+                print(f"❌ Failed to send email to {to_email}: {exception}")
+                log_rows.append((now, customer_id, 'EMAIL_FAILED', f'Error: {str(exception)}'))
+    
+    with _transaction() as conn:
+        _log_actions(conn, log_rows)
+    return sum(1 for row in log_rows if row[2] == 'EMAIL_SENT')
+
+# id_expiry is a real YYYY-MM-DD calendar date: julianday() alone also accepts bare day
+# numbers ('2023') and datetimes, and date() alone accepts days like 2024-02-30
+VALID_EXPIRY_SQL = "date(id_expiry, '+0 days') = id_expiry"
+# Whole days from today (local time) until id_expiry; only meaningful where VALID_EXPIRY_SQL holds
+DAYS_UNTIL_EXPIRY_SQL = "CAST(julianday(id_expiry) - julianday(date('now', 'localtime')) AS INTEGER)"
+# Expired or expiring within 30 days (range scan on idx_expiry)
+EXPIRY_WINDOW_SQL = f"id_expiry <= date('now', 'localtime', '+30 day') AND {VALID_EXPIRY_SQL}"
+
 def check_and_notify_expired_ids(notification_email: str = None, use_saved_emails: bool = False):
     """Check for expired IDs and send automated notifications
     
@@ -570,150 +1147,107 @@ def check_and_notify_expired_ids(notification_email: str = None, use_saved_email
         notification_email: Manual email override (for testing)
         use_saved_emails: If True, use customer_email from database instead
     """
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT customer_id, name, id_expiry, status, customer_email FROM kyc_records WHERE id_expiry IS NOT NULL')
-    records = c.fetchall()
-    conn.close()
+    # Only expired or expiring-within-30-days rows leave SQLite (range scan on idx_expiry)
+    with _DB_LOCK:
+        records = _CONN.execute(f'''SELECT customer_id, name, id_expiry, status, customer_email, {DAYS_UNTIL_EXPIRY_SQL}
+                                   FROM kyc_records
+                                   WHERE {EXPIRY_WINDOW_SQL}''').fetchall()
     
-    today = datetime.now().date()
-    notified_count = 0
+    notifications = []
     
-    print(f"\n🔍 Checking {len(records)} records for expired IDs...")
+    print(f"\n🔍 {len(records)} records have expired or expiring IDs...")
     
-    for customer_id, name, id_expiry_str, status, saved_email in records:
-        try:
-            # Determine which email to use
-            target_email = saved_email if use_saved_emails else notification_email
-            
-            if not target_email:
-                print(f"⚠️  {customer_id}: No email address available, skipping")
-                continue
-            
-            # Parse expiry date
-            id_expiry = datetime.strptime(id_expiry_str, '%Y-%m-%d').date()
-            days_until_expiry = (id_expiry - today).days
-            
-            # Check if expired
-            if days_until_expiry < 0:
-                print(f"⚠️  {customer_id}: ID expired {abs(days_until_expiry)} days ago")
-                send_email_notification(
-                    target_email, 
-                    customer_id, 
-                    name, 
-                    id_expiry_str, 
-                    "expired"
-                )
-                notified_count += 1
-            
-            # Check if expiring within 30 days
-            elif 0 <= days_until_expiry <= 30:
-                print(f"🔔 {customer_id}: ID expires in {days_until_expiry} days")
-                send_email_notification(
-                    target_email, 
-                    customer_id, 
-                    name, 
-                    id_expiry_str, 
-                    "expiring_soon"
-                )
-                notified_count += 1
-            else:
-                print(f"✅ {customer_id}: ID valid for {days_until_expiry} days")
-                
-        except ValueError:
-            print(f"⚠️  {customer_id}: Invalid date format: {id_expiry_str}")
+    for customer_id, name, id_expiry_str, status, saved_email, days_until_expiry in records:
+        # Determine which email to use
+        target_email = saved_email if use_saved_emails else notification_email
+        
+        if not target_email:
+            print(f"⚠️  {customer_id}: No email address available, skipping")
             continue
+        
+        # Check if expired
+        if days_until_expiry < 0:
+            print(f"⚠️  {customer_id}: ID expired {abs(days_until_expiry)} days ago")
+            notifications.append((target_email, customer_id, name, id_expiry_str, "expired"))
+        
+        # Otherwise expiring within 30 days
+        else:
+            print(f"🔔 {customer_id}: ID expires in {days_until_expiry} days")
+            notifications.append((target_email, customer_id, name, id_expiry_str, "expiring_soon"))
+    
+    # All emails go out in batched requests, outside any DB transaction
+    notified_count = send_email_notifications(notifications) if notifications else 0
     
     print(f"\n📧 Sent {notified_count} notification emails")
     return notified_count
 
 def get_expired_customers():
+    """Return (expired, expiring_soon, has_saved_emails)
     
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT customer_id, name, id_expiry, id_type FROM kyc_records WHERE id_expiry IS NOT NULL')
-    records = c.fetchall()
-    conn.close()
+    has_saved_emails is True when an expired or expiring customer has a saved email to notify.
+    """
+    with _DB_LOCK:
+        records = _CONN.execute(f'''SELECT customer_id, name, id_expiry, id_type, customer_email, {DAYS_UNTIL_EXPIRY_SQL}
+                                   FROM kyc_records
+                                   WHERE {EXPIRY_WINDOW_SQL}''').fetchall()
     
-    today = datetime.now().date()
     expired = []
     expiring_soon = []
+    has_saved_emails = False
     
-    for customer_id, name, id_expiry_str, id_type in records:
-        try:
-            id_expiry = datetime.strptime(id_expiry_str, '%Y-%m-%d').date()
-            days_until_expiry = (id_expiry - today).days
-            
-            if days_until_expiry < 0:
-                expired.append({
-                    'customer_id': customer_id,
-                    'name': name,
-                    'id_type': id_type,
-                    'id_expiry': id_expiry_str,
-                    'days_expired': abs(days_until_expiry)
-                })
-            elif 0 <= days_until_expiry <= 30:
-                expiring_soon.append({
-                    'customer_id': customer_id,
-                    'name': name,
-                    'id_type': id_type,
-                    'id_expiry': id_expiry_str,
-                    'days_remaining': days_until_expiry
-                })
-        except ValueError:
-            continue
+    for customer_id, name, id_expiry_str, id_type, customer_email, days_until_expiry in records:
+        has_saved_emails = has_saved_emails or customer_email is not None
+        if days_until_expiry < 0:
+            expired.append({
+                'customer_id': customer_id,
+                'name': name,
+                'id_type': id_type,
+                'id_expiry': id_expiry_str,
+                'days_expired': abs(days_until_expiry)
+            })
+        else:
+            expiring_soon.append({
+                'customer_id': customer_id,
+                'name': name,
+                'id_type': id_type,
+                'id_expiry': id_expiry_str,
+                'days_remaining': days_until_expiry
+            })
     
-    return expired, expiring_soon
+    return expired, expiring_soon, has_saved_emails
 
 def revalidate_all_records():
     """Re-validate all existing records to check for expired IDs"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT customer_id, id_expiry, status, validation_result, flags FROM kyc_records WHERE id_expiry IS NOT NULL')
-    records = c.fetchall()
+    # Only APPROVED records whose ID has already expired need rewriting
+    with _DB_LOCK:
+        records = _CONN.execute(f'''SELECT customer_id, id_expiry, {DAYS_UNTIL_EXPIRY_SQL}
+                                   FROM kyc_records
+                                   WHERE status = 'APPROVED'
+                                     AND id_expiry < date('now', 'localtime')
+                                     AND {VALID_EXPIRY_SQL}''').fetchall()
     
-    today = datetime.now().date()
-    updated_count = 0
+    updates = []
+    new_flags = []
     
-    print(f"\n🔄 Re-validating {len(records)} records...")
+    print(f"\n🔄 Re-validating {len(records)} approved records with expired IDs...")
     
-    for customer_id, id_expiry_str, current_status, validation_json, flags_json in records:
-        try:
-            id_expiry = datetime.strptime(id_expiry_str, '%Y-%m-%d').date()
-            days_until_expiry = (id_expiry - today).days
-            
-            # Check if expired but marked as APPROVED
-            if days_until_expiry < 0 and current_status == 'APPROVED':
-                days_expired = abs(days_until_expiry)
-                
-                # Update to REJECTED
-                validation_result = json.loads(validation_json) if validation_json else {}
-                flags = json.loads(flags_json) if flags_json else []
-                
-                # Add expiry flag
-                expiry_flag = f"ID expired {days_expired} days ago on {id_expiry_str}"
-                if expiry_flag not in flags:
-                    flags.append(expiry_flag)
-                
-                # Update validation result
-                validation_result['validation_status'] = 'REJECTED'
-                validation_result['flags'] = flags
-                validation_result['compliance_report'] = f"❌ REJECTED: ID expired {days_expired} days ago. " + validation_result.get('compliance_report', '')
-                
-                # Update database
-                c.execute('''UPDATE kyc_records 
-                            SET status = ?, validation_result = ?, flags = ?
-                            WHERE customer_id = ?''',
-                         ('REJECTED', json.dumps(validation_result), json.dumps(flags), customer_id))
-                
-                print(f"✅ Updated {customer_id}: APPROVED → REJECTED (expired {days_expired} days ago)")
-                updated_count += 1
-                
-        except ValueError:
-            continue
+    for customer_id, id_expiry_str, days_until_expiry in records:
+        days_expired = abs(days_until_expiry)
+        
+        # Update to REJECTED, prefixing the existing report
+        updates.append((f"❌ REJECTED: ID expired {days_expired} days ago. ", customer_id))
+        new_flags.append((customer_id, f"ID expired {days_expired} days ago on {id_expiry_str}"))
+        print(f"✅ Updated {customer_id}: APPROVED → REJECTED (expired {days_expired} days ago)")
     
-    conn.commit()
-    conn.close()
+    # Plain column writes in one transaction; validation_result holds none of these fields
+    with _transaction() as conn:
+        conn.executemany('''UPDATE kyc_records 
+                            SET status = 'REJECTED', compliance_report = ? || COALESCE(compliance_report, '')
+                            WHERE customer_id = ?''', updates)
+        conn.executemany('''INSERT INTO kyc_flags (customer_id, flag)
+                            SELECT ?1, ?2 WHERE NOT EXISTS
+                                (SELECT 1 FROM kyc_flags WHERE customer_id = ?1 AND flag = ?2)''', new_flags)
+    updated_count = len(updates)
     
     print(f"✅ Re-validation complete: {updated_count} records updated\n")
     return updated_count
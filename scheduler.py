@@ -1,31 +1,37 @@
-
-import schedule
-import time
+import signal
+import threading
 from kyc_agent import process_kyc_workflow, generate_compliance_report
 from datetime import datetime
 
+INTERVAL_SECONDS = 30 * 60
+
+# Set by SIGINT/SIGTERM; the wait between runs returns immediately instead of polling
+stop_event = threading.Event()
+
 def scheduled_task():
     print(f"\n{'='*60}")
     print(f"🕐 Scheduled KYC Processing - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print(f"{'='*60}\n")
-    
+
     try:
         process_kyc_workflow()
         print("\n" + generate_compliance_report())
     except Exception as e:
         print(f"❌ Error during scheduled processing: {str(e)}")
 
-# Schedule the task every 30 minutes
-schedule.every(30).minutes.do(scheduled_task)
+def request_stop(signum, frame):
+    stop_event.set()
+
+signal.signal(signal.SIGTERM, request_stop)
+signal.signal(signal.SIGINT, request_stop)
 
 print("🤖 KYC Compliance Agent Scheduler Started")
 print("⏰ Running KYC processing every 30 minutes")
 print("Press Ctrl+C to stop\n")
 
-# Run once immediately
-scheduled_task()
+# Run once immediately, then sleep until the next run (or a stop signal)
+while not stop_event.is_set():
+    scheduled_task()
+    stop_event.wait(INTERVAL_SECONDS)
 
-# Keep running
-while True:
-    schedule.run_pending()
-    time.sleep(60)  # Check every minute
+print("👋 Scheduler stopped")